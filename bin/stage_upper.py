@@ -14,30 +14,50 @@ if not out_dir:
 Path(out_dir).mkdir(parents=True, exist_ok=True)
 
 line_offset = int(os.environ.get('PIPELINE_LINE_OFFSET', '0'))
-progress_path = os.path.join('state', f"progress_stage_upper.json")
+stage_name = os.environ.get('PIPELINE_STAGE_NAME', 'stage_upper')
+progress_path = os.path.join(os.environ.get('PIPELINE_STATE_DIR', 'state'), f"progress_{stage_name}.json")
 
 input_file = inputs[0]
 output_file = os.path.join(out_dir, 'result.txt')
 
-# If resuming, read existing output lines
-existing_lines = []
-if line_offset > 0 and os.path.exists(output_file):
-    with open(output_file, 'r', encoding='utf-8') as f:
-        existing_lines = f.readlines()
+# If resuming, drop output written after the last recorded offset so those lines are not duplicated
+mode = 'w'
+if line_offset > 0 and not os.path.exists(output_file):
+    line_offset = 0
+if line_offset > 0:
+    with open(output_file, 'r+b') as f:
+        kept = 0
+        while kept < line_offset:
+            start = f.tell()
+            if not f.readline().endswith(b'\n'):
+                # EOF or a half-written line: cut back to where it starts
+                f.seek(start)
+                break
+            kept += 1
+        f.truncate()
+    # Output shorter than the recorded offset (lost on a crash): redo the lines it is missing
+    line_offset = kept
+    mode = 'a'
+
+
+def write_progress(fout, offset):
+    # Flushed so progress rarely runs ahead of the output; if a crash still leaves it short,
+    # the resume above redoes the missing lines, so no fsync is needed
+    fout.flush()
+    with open(progress_path, 'w', encoding='utf-8') as pf:
+        json.dump({'lineOffset': offset}, pf)
+
 
 processed = 0
-with open(input_file, 'r', encoding='utf-8') as fin, open(output_file, 'a', encoding='utf-8') as fout:
+with open(input_file, 'r', encoding='utf-8') as fin, open(output_file, mode, encoding='utf-8') as fout:
     for idx, line in enumerate(fin):
         if idx < line_offset:
             continue
         fout.write(line.upper())
         processed += 1
         if processed % 50 == 0:
-            with open(progress_path, 'w', encoding='utf-8') as pf:
-                json.dump({'lineOffset': idx + 1}, pf)
-
-# Final progress write
-with open(progress_path, 'w', encoding='utf-8') as pf:
-    json.dump({'lineOffset': line_offset + processed}, pf)
+            write_progress(fout, idx + 1)
+    # Final progress write
+    write_progress(fout, line_offset + processed)
 
 print("stage_upper completed")
@@ -1,31 +1,86 @@
 import argparse
 import json
 import hashlib
+import mmap
 import os
+import random
 import time
 from datetime import datetime
 from typing import List, Dict
 import subprocess
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 STATE_DIR = "state"
 LOCKS_DIR = "locks"
+# Retry backoff sleeps through this name so tests can stub it without touching time.sleep
+sleep = time.sleep
+
+
+def state_dir() -> str:
+    # Read per call so one process can drive runs against different state dirs
+    return os.environ.get('PIPELINE_STATE_DIR', STATE_DIR)
+
+
+def locks_dir() -> str:
+    return os.environ.get('PIPELINE_LOCKS_DIR', LOCKS_DIR)
 
-os.makedirs(STATE_DIR, exist_ok=True)
-os.makedirs(LOCKS_DIR, exist_ok=True)
-os.makedirs("data/input", exist_ok=True)
-os.makedirs("data/work", exist_ok=True)
-os.makedirs("data/output", exist_ok=True)
+
+def ensure_dirs():
+    # Created on each run rather than at import so the module can be used in-process
+    for d in (state_dir(), locks_dir(), "data/input", "data/work", "data/output"):
+        os.makedirs(d, exist_ok=True)
+
+
+class LockHeldError(RuntimeError):
+    pass
+
+
+# Non-blocking exclusive lock; flock is held per open fd, so it excludes other processes too
+class FileLock:
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            raise LockHeldError(f"Lock held by another run: {self.path}")
+        self.fd = fd
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+        self.fd = None
 
 
 def sha256_file(path: str) -> str:
-    h = hashlib.sha256()
     with open(path, 'rb') as f:
-        while True:
-            chunk = f.read(8192)
-            if not chunk:
-                break
-            h.update(chunk)
-    return h.hexdigest()
+        if os.fstat(f.fileno()).st_size == 0:  # mmap rejects empty files
+            return hashlib.sha256().hexdigest()
+        # Hash the mapped pages directly: no Python-level read loop or intermediate copies
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
 
 
 def get_processor_version(processor_path: str) -> str:
@@ -42,7 +97,7 @@ def load_pipeline(pipeline_path: str) -> Dict:
 
 
 def load_stage_state(stage_name: str) -> Dict:
-    path = os.path.join(STATE_DIR, f"stage_{stage_name}.json")
+    path = os.path.join(state_dir(), f"stage_{stage_name}.json")
     if os.path.exists(path):
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
@@ -50,7 +105,7 @@ def load_stage_state(stage_name: str) -> Dict:
 
 
 def save_stage_state(stage_name: str, data: Dict):
-    path = os.path.join(STATE_DIR, f"stage_{stage_name}.json")
+    path = os.path.join(state_dir(), f"stage_{stage_name}.json")
     tmp = path + ".tmp"
     with open(tmp, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
@@ -58,13 +113,39 @@ def save_stage_state(stage_name: str, data: Dict):
 
 
 def save_run_state(run_id: str, data: Dict):
-    path = os.path.join(STATE_DIR, f"run_{run_id}.json")
+    path = os.path.join(state_dir(), f"run_{run_id}.json")
     tmp = path + ".tmp"
     with open(tmp, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
     os.replace(tmp, path)
 
 
+def apply_resource_limits(limits: Dict) -> Dict[str, str]:
+    # Map a stage's `resources` block to PIPELINE_* env vars; returns them rather than touching os.environ
+    applied = {}
+    if 'cpuCores' in limits:
+        applied['PIPELINE_CPU_CORES'] = str(int(limits['cpuCores']))
+    if 'memoryMB' in limits:
+        applied['PIPELINE_MEMORY_MB'] = str(int(limits['memoryMB']))
+    if 'ioConcurrency' in limits:
+        applied['PIPELINE_IO_CONCURRENCY'] = str(int(limits['ioConcurrency']))
+    return applied
+
+
+def memory_cap_preexec(limits: Dict):
+    # Enforce memoryMB as an address-space cap in the child. Only Linux enforces RLIMIT_AS;
+    # macOS accepts the call but ignores the limit, and Windows has no resource module
+    if resource is None or 'memoryMB' not in limits:
+        return None
+    cap = int(limits['memoryMB']) * 1024 * 1024
+    return lambda: resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+
+def backoff_delay(attempt: int, base_delay: float, jitter: float) -> float:
+    # Exponential backoff: base * 2^(attempt-1), stretched by up to `jitter` fraction
+    return base_delay * (2 ** (attempt - 1)) * (1 + random.uniform(0, jitter))
+
+
 def compute_idempotency_key(inputs: List[str], processor_path: str) -> str:
     parts = []
     for p in inputs:
@@ -78,6 +159,18 @@ def compute_idempotency_key(inputs: List[str], processor_path: str) -> str:
 
 
 def run_stage(stage: Dict, run_id: str):
+    name = stage['name']
+    lock_path = os.path.join(locks_dir(), f"{name}.lock")
+    try:
+        with FileLock(lock_path):
+            return execute_stage(stage, run_id)
+    except LockHeldError as e:
+        # The stage state belongs to the lock holder; the failure is recorded in run state and metrics
+        print(f"[FAIL] {name}: {e}")
+        return {'stage': name, 'status': 'failed', 'error': str(e)}
+
+
+def execute_stage(stage: Dict, run_id: str):
     name = stage['name']
     processor = stage['processor']
     inputs = stage.get('inputs', [])
@@ -86,20 +179,26 @@ def run_stage(stage: Dict, run_id: str):
     stage_state = load_stage_state(name)
 
     idem_enabled = stage.get('idempotency', {}).get('enabled', False)
-    idem_key = compute_idempotency_key(inputs, processor) if idem_enabled else None
+    checkpoint_cfg = stage.get('checkpoint', {})
+    cp_enabled = checkpoint_cfg.get('enabled', False)
+    # Checkpointed stages need the key too: progress is only valid for the inputs it was recorded on
+    idem_key = compute_idempotency_key(inputs, processor) if idem_enabled or cp_enabled else None
 
     output_marker = os.path.join(output_dir, f".{name}.done")
     if idem_enabled and 'idempotencyKey' in stage_state and stage_state['idempotencyKey'] == idem_key and os.path.exists(output_marker):
         print(f"[SKIP] {name} (idempotent key matched)")
         return {'stage': name, 'status': 'skipped'}
 
-    checkpoint_cfg = stage.get('checkpoint', {})
-    cp_enabled = checkpoint_cfg.get('enabled', False)
     cp_line_interval = int(checkpoint_cfg.get('lineInterval', 0))
-    cp_path = os.path.join(STATE_DIR, f"checkpoint_{name}.json")
+    cp_path = os.path.join(state_dir(), f"checkpoint_{name}.json")
+    progress_file = os.path.join(state_dir(), f"progress_{name}.json")
     line_offset = 0
-    if cp_enabled and os.path.exists(cp_path):
-        with open(cp_path, 'r', encoding='utf-8') as f:
+    # Resume from the processor's own progress: it survives an interrupted run, the checkpoint does not
+    if cp_enabled and os.path.exists(progress_file) and stage_state.get('progressKey') != idem_key:
+        # Left by a run over other inputs or another processor version; its offset does not apply
+        os.remove(progress_file)
+    elif cp_enabled and os.path.exists(progress_file):
+        with open(progress_file, 'r', encoding='utf-8') as f:
             try:
                 cp_data = json.load(f)
                 line_offset = int(cp_data.get('lineOffset', 0))
@@ -118,11 +217,41 @@ def run_stage(stage: Dict, run_id: str):
         env['PIPELINE_STAGE_NAME'] = name
         env['PIPELINE_OUTPUT_DIR'] = os.path.abspath(output_dir)
         env['PIPELINE_LINE_OFFSET'] = str(line_offset)
-        cmd = ['python', processor] + inputs
-        proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
-        if proc.returncode != 0:
+        env['PIPELINE_STATE_DIR'] = os.path.abspath(state_dir())
+        limits = stage.get('resources', {})
+        env.update(apply_resource_limits(limits))
+        if cp_enabled:
+            # Recorded before launch so an interrupted run leaves progress tied to these inputs
+            stage_state['progressKey'] = idem_key
+            save_stage_state(name, stage_state)
+        # Same interpreter as the runner: no PATH lookup, and processors see the same Python
+        cmd = [sys.executable or 'python', processor] + inputs
+
+        # Only exit codes listed as retryable (default EX_TEMPFAIL) are retried
+        retry_cfg = stage.get('retry', {})
+        max_attempts = max(1, int(retry_cfg.get('maxAttempts', 1)))
+        # PIPELINE_RETRY_* env vars override the spec, e.g. to keep CI backoff short
+        base_delay = float(os.environ.get('PIPELINE_RETRY_BASE_DELAY', retry_cfg.get('baseDelay', 0.5)))
+        jitter = float(os.environ.get('PIPELINE_RETRY_JITTER', retry_cfg.get('jitter', 0)))
+        retryable = set(retry_cfg.get('retryableExitCodes', [75]))
+        attempt = 0
+        while True:
+            attempt += 1
+            result['attempts'] = attempt
+            # Processor stdout is never read; stderr stays bytes and is decoded only on final failure
+            proc = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  preexec_fn=memory_cap_preexec(limits))
+            # Signal deaths come back negative; use the shell's 128+N so 137/143 can be listed
+            code = proc.returncode if proc.returncode >= 0 else 128 - proc.returncode
+            if code == 0:
+                break
+            if code in retryable and attempt < max_attempts:
+                delay = backoff_delay(attempt, base_delay, jitter)
+                print(f"[RETRY] {name} attempt {attempt} exited {code}, retrying in {delay:.3f}s")
+                sleep(delay)
+                continue
             result['status'] = 'failed'
-            result['error'] = proc.stderr.strip() or proc.stdout.strip()
+            result['error'] = proc.stderr.decode('utf-8', 'replace').strip() or f"exit code {code}"
             raise RuntimeError(result['error'])
 
         # Write output marker
@@ -134,24 +263,26 @@ def run_stage(stage: Dict, run_id: str):
         print(f"[FAIL] {name}: {e}")
         stage_state['lastError'] = str(e)
         stage_state['lastStatus'] = 'failed'
+        stage_state['lastAttempts'] = result.get('attempts', 0)
         save_stage_state(name, stage_state)
-        return {'stage': name, 'status': 'failed', 'error': str(e)}
+        return {'stage': name, 'status': 'failed', 'error': str(e), 'attempts': result.get('attempts', 0)}
 
-    # Update checkpoint if enabled (processor may emit progress file)
+    # Record the completed offset, then clear progress so the next execution starts from line 0
     if cp_enabled:
-        progress_file = os.path.join(STATE_DIR, f"progress_{name}.json")
         if os.path.exists(progress_file):
             try:
                 with open(progress_file, 'r', encoding='utf-8') as pf:
                     prog = json.load(pf)
                 with open(cp_path, 'w', encoding='utf-8') as cf:
                     json.dump({'lineOffset': prog.get('lineOffset', 0)}, cf)
+                os.remove(progress_file)
             except Exception:
                 pass
 
     duration = time.time() - start_ts
     stage_state['lastDurationSec'] = duration
     stage_state['lastStatus'] = result['status']
+    stage_state['lastAttempts'] = result['attempts']
     if idem_enabled:
         stage_state['idempotencyKey'] = idem_key
     save_stage_state(name, stage_state)
@@ -169,30 +300,26 @@ def aggregate_metrics(run_id: str, results: List[Dict]):
         'skippedStages': sum(1 for r in results if r['status'] == 'skipped'),
         'okStages': sum(1 for r in results if r['status'] == 'ok')
     }
-    path = os.path.join(STATE_DIR, f"metrics_{run_id}.json")
+    path = os.path.join(state_dir(), f"metrics_{run_id}.json")
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(metrics, f, ensure_ascii=False, indent=2)
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--pipeline', required=True)
-    parser.add_argument('--run-id', required=True)
-    args = parser.parse_args()
-
-    pipeline = load_pipeline(args.pipeline)
+def run_pipeline(pipeline_path: str, run_id: str) -> Dict:
+    ensure_dirs()
+    pipeline = load_pipeline(pipeline_path)
     run_state = {
-        'runId': args.run_id,
+        'runId': run_id,
         'pipeline': pipeline['name'],
         'version': pipeline.get('version'),
         'startedAt': datetime.utcnow().isoformat(),
         'state': 'running'
     }
-    save_run_state(args.run_id, run_state)
+    save_run_state(run_id, run_state)
 
     results = []
     for stage in pipeline['stages']:
-        res = run_stage(stage, args.run_id)
+        res = run_stage(stage, run_id)
         results.append(res)
         if res['status'] == 'failed':
             run_state['state'] = 'failed'
@@ -201,10 +328,34 @@ def main():
         run_state['state'] = 'completed'
 
     run_state['endedAt'] = datetime.utcnow().isoformat()
-    save_run_state(args.run_id, run_state)
-    aggregate_metrics(args.run_id, results)
-    print(f"Run {args.run_id} state: {run_state['state']}")
+    save_run_state(run_id, run_state)
+    aggregate_metrics(run_id, results)
+    print(f"Run {run_id} state: {run_state['state']}")
+    return run_state
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pipeline', required=True)
+    parser.add_argument('--run-id', required=True)
+    parser.add_argument('--state-dir', help='defaults to $PIPELINE_STATE_DIR or ./state')
+    parser.add_argument('--locks-dir', help='defaults to $PIPELINE_LOCKS_DIR or ./locks')
+    args = parser.parse_args(argv)
+    # Set for this run only (processors inherit them), then restored for in-process callers
+    overrides = {k: v for k, v in (('PIPELINE_STATE_DIR', args.state_dir),
+                                   ('PIPELINE_LOCKS_DIR', args.locks_dir)) if v}
+    saved = {k: os.environ.get(k) for k in overrides}
+    os.environ.update(overrides)
+    try:
+        run_state = run_pipeline(args.pipeline, args.run_id)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    return 0 if run_state['state'] == 'completed' else 1
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,207 @@
+import io
+import os
+import sys
+import copy
+import json
+import shutil
+import contextlib
+import threading
+import subprocess
+from collections import deque
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import src.pipeline_runner as _pr  # noqa: E402
+from tests.helpers import load_json  # noqa: E402
+
+SRC = ROOT / "src" / "pipeline_runner.py"
+PIPELINE = ROOT / "pipeline.json"
+INPUT = ROOT / "data" / "input" / "sample.txt"
+# The pytest interpreter itself: no PATH lookup, and no chance of picking up another Python
+_BASE_CMD = [sys.executable, str(SRC)]
+
+SAMPLE_TEXT = (
+    "Hello World\n"
+    "This is a demo pipeline.\n"
+    "It converts text to UPPERCASE.\n"
+    "Repeated runs should be idempotent if unchanged.\n"
+)
+
+
+def _make_workspace(base: Path, pipeline_spec: dict) -> SimpleNamespace:
+    # Private copy of the demo pipeline: data paths point under `base`, processors stay in the repo
+    def rebase(p: str) -> str:
+        return str(base / p) if p.startswith("data/") else p
+
+    spec = copy.deepcopy(pipeline_spec)
+    for stage in spec["stages"]:
+        stage["processor"] = str(ROOT / stage["processor"])
+        stage["inputs"] = [rebase(p) for p in stage.get("inputs", [])]
+        stage["outputDir"] = rebase(stage["outputDir"])
+    ws = SimpleNamespace(
+        root=base,
+        state=base / "state",
+        locks=base / "locks",
+        work=base / "data" / "work",
+        output=base / "data" / "output",
+        input=base / "data" / "input" / "sample.txt",
+        pipeline=base / "pipeline.json",
+    )
+    ws.input.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(INPUT, ws.input)
+    ws.pipeline.write_text(json.dumps(spec), encoding="utf-8")
+    ws.env = {"PIPELINE_STATE_DIR": str(ws.state), "PIPELINE_LOCKS_DIR": str(ws.locks)}
+    return ws
+
+
+def _run_pipeline(run_id: str, pipeline: Path | str = PIPELINE, env: dict[str, str] | None = None):
+    # In-process equivalent of the CLI: same exit code, captured stdout/stderr
+    buf_o, buf_e = io.StringIO(), io.StringIO()
+    with mock.patch.dict(os.environ, env or {}), \
+            contextlib.redirect_stdout(buf_o), contextlib.redirect_stderr(buf_e):
+        run_state = _pr.run_pipeline(str(pipeline), run_id)
+    rc = 0 if run_state["state"] == "completed" else 1
+    return rc, buf_o.getvalue(), buf_e.getvalue()
+
+
+def _subprocess_env(env: dict[str, str] | None = None) -> dict[str, str]:
+    # The runner is measured in-process; keep coverage from re-instrumenting child interpreters
+    base = {k: v for k, v in os.environ.items() if not k.startswith(("COVERAGE_", "COV_CORE_"))}
+    return {**base, **(env or {})}
+
+
+def _run_pipeline_until(run_id: str, markers: set[str], pipeline: Path | str = PIPELINE,
+                        args: list[str] | None = None, timeout: float = 30.0, keep: int = 50):
+    # Real interpreter for the CLI entrypoint; output is scanned line by line and only the
+    # last `keep` lines are retained, for failure messages
+    cmd = [*_BASE_CMD, "--pipeline", str(pipeline), "--run-id", run_id, *(args or [])]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=_subprocess_env())
+    # Reading stdout blocks until EOF, so the deadline is enforced by killing a hung child
+    watchdog = threading.Timer(timeout, proc.kill)
+    watchdog.start()
+    # Lines are matched as bytes, so nothing is decoded unless it is reported
+    wanted = {m.encode("utf-8"): m for m in markers}
+    seen, tail = set(), deque(maxlen=keep)
+    try:
+        for line in proc.stdout:
+            tail.append(line)
+            if seen != markers:
+                seen.update(m for b, m in wanted.items() if b in line)
+    finally:
+        watchdog.cancel()
+        proc.stdout.close()
+    return proc.wait(), seen, b"".join(tail).decode("utf-8", "replace")
+
+
+_TMPROOT_SET = pytest.StashKey[bool]()
+
+
+def pytest_configure(config):
+    # Root tmp_path under tmpfs when there is one, so workspace IO and state renames stay in
+    # memory. pytest still builds its own pytest-of-<user>/pytest-N dirs there, so numbered
+    # rotation and the retention policy from pytest.ini (dirs of failed tests only) apply.
+    # An explicit --basetemp or PYTEST_DEBUG_TEMPROOT wins.
+    if getattr(config, "workerinput", {}).get("pipeline_tmproot"):
+        # xdist worker: basetemp comes from the controller; drop the variable inherited with its env
+        os.environ.pop("PYTEST_DEBUG_TEMPROOT", None)
+        return
+    if config.option.basetemp or "PYTEST_DEBUG_TEMPROOT" in os.environ:
+        return
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        os.environ["PYTEST_DEBUG_TEMPROOT"] = str(shm)
+        config.stash[_TMPROOT_SET] = True
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    if node.config.stash.get(_TMPROOT_SET, False):
+        node.workerinput["pipeline_tmproot"] = True
+
+
+def pytest_unconfigure(config):
+    if config.stash.get(_TMPROOT_SET, False):
+        os.environ.pop("PYTEST_DEBUG_TEMPROOT", None)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def release_tmproot(tmp_path_factory, pytestconfig):
+    # Only needed until the basetemp exists; keep it out of processors and the CLI child
+    if pytestconfig.stash.get(_TMPROOT_SET, False):
+        tmp_path_factory.getbasetemp()
+        os.environ.pop("PYTEST_DEBUG_TEMPROOT", None)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def setup_input_file():
+    # Processor paths and the runner's default dirs are relative to the repo root
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(ROOT)
+        if not INPUT.exists():
+            INPUT.parent.mkdir(parents=True, exist_ok=True)
+            INPUT.write_text(SAMPLE_TEXT, encoding="utf-8")
+        yield
+
+
+@pytest.fixture(scope="session")
+def pr():
+    # The runner module, imported once at collection time above
+    return _pr
+
+
+@pytest.fixture(scope="session")
+def pipeline_spec():
+    # Parsed once; treat as read-only and deepcopy before modifying
+    return load_json(PIPELINE)
+
+
+@pytest.fixture(scope="session")
+def input_upper(setup_input_file):
+    return INPUT.read_text(encoding="utf-8").upper()
+
+
+@pytest.fixture
+def tmp_pipeline_factory(tmp_path_factory):
+    # Writes a spec (dict, or already-serialized bytes) into a fresh dir pytest cleans up
+    def make(spec: dict | bytes) -> Path:
+        path = tmp_path_factory.mktemp("spec") / "pipeline.json"
+        path.write_bytes(spec if isinstance(spec, bytes) else json.dumps(spec).encode("utf-8"))
+        return path
+    return make
+
+
+@pytest.fixture
+def workspace(tmp_path, pipeline_spec):
+    return _make_workspace(tmp_path, pipeline_spec)
+
+
+@pytest.fixture(scope="session")
+def first_run_artifacts(tmp_path_factory, pipeline_spec):
+    # The one clean CLI run of the suite; tests needing a primed state build on it
+    ws = _make_workspace(tmp_path_factory.mktemp("first_run"), pipeline_spec)
+    markers = {"[DONE] stage_copy", "[DONE] stage_upper"}
+    rc, seen, tail = _run_pipeline_until("t1", markers, pipeline=ws.pipeline,
+                                         args=["--state-dir", str(ws.state), "--locks-dir", str(ws.locks)])
+    return SimpleNamespace(ws=ws, run_id="t1", rc=rc, markers=markers, seen=seen, tail=tail,
+                           state=ws.state, output=ws.output)
+
+
+@pytest.fixture(scope="module")
+def second_run(first_run_artifacts):
+    # Unchanged rerun on top of the first run, shared by the tests asserting on it
+    ws = first_run_artifacts.ws
+    return _run_pipeline("t2", pipeline=ws.pipeline, env=ws.env)
+
+
+@pytest.fixture
+def run_pipeline(workspace):
+    # Runs against the test's workspace unless another spec is given
+    def _run(run_id: str, pipeline: Path | str | None = None, env: dict[str, str] | None = None):
+        return _run_pipeline(run_id, pipeline=pipeline or workspace.pipeline, env={**workspace.env, **(env or {})})
+    return _run
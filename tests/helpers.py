@@ -0,0 +1,15 @@
+from pathlib import Path
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # optional speedup; stdlib json also parses bytes
+    from json import loads as json_loads
+
+
+def load_json(path: Path | str):
+    return json_loads(Path(path).read_bytes())
+
+
+def load_all(paths) -> list:
+    # One parser call for several small files; any invalid file still fails the parse
+    return json_loads(b"[" + b",".join(Path(p).read_bytes() for p in paths) + b"]")
@@ -1,65 +1,400 @@
 import os
+import re
+import sys
+import glob
 import json
-import subprocess
+import hashlib
 from pathlib import Path
 
-ROOT = Path(__file__).resolve().parents[1]
-SRC = ROOT / "src" / "pipeline_runner.py"
-PIPELINE = ROOT / "pipeline.json"
-STATE = ROOT / "state"
-OUTPUT = ROOT / "data" / "output"
-WORK = ROOT / "data" / "work"
+import pytest
 
+from tests.helpers import load_all, load_json
 
-def run(cmd: list[str]):
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    assert proc.returncode == 0, f"Command failed: {cmd}\nstdout: {proc.stdout}\nstderr: {proc.stderr}"
-    return proc.stdout
+NETWORK_MODULES = ("socket", "requests", "http.client", "urllib", "urllib3", "asyncio", "aiohttp",
+                   "ftplib", "smtplib", "paramiko")
+# One alternation compiled once, so each file is scanned in a single pass
+NETWORK_IMPORT = re.compile(
+    rb"^\s*(?:import|from)\s+(" + b"|".join(re.escape(m.encode()) for m in NETWORK_MODULES) + rb")\b", re.M)
+# Dot-dirs (.git, .venv, .tox, .nox, caches) are pruned wholesale; these are the rest
+SKIP_DIRS = {"venv", "build", "dist", "__pycache__"}
 
 
-def test_first_run_produces_output(tmp_path):
-    # Clean output/state for a fresh run
-    for p in [STATE, OUTPUT, WORK]:
-        p.mkdir(parents=True, exist_ok=True)
-        # remove files inside
-        for child in p.glob("**/*"):
-            try:
-                if child.is_file():
-                    child.unlink()
-            except Exception:
-                pass
-
-    stdout = run(["python", str(SRC), "--pipeline", str(PIPELINE), "--run-id", "t1"])
-    # Uppercase stage produces result.txt
-    result = OUTPUT / "result.txt"
-    assert result.exists(), "result.txt should exist after first run"
+@pytest.mark.xdist_group("first_run")
+def test_first_run_produces_output(first_run_artifacts, input_upper):
+    art = first_run_artifacts
+    assert art.rc == 0 and art.seen == art.markers, \
+        f"CLI run exited {art.rc}, missed {art.markers - art.seen}; last output:\n{art.tail}"
+    # Uppercase stage produces result.txt; a missing file fails the read itself, no stat first
+    try:
+        result = (art.output / "result.txt").read_bytes().decode("utf-8")
+    except FileNotFoundError:
+        pytest.fail("result.txt should exist after first run")
+    assert result == input_upper
 
     # State files exist and parse
-    run_state = STATE / "run_t1.json"
-    metrics = STATE / "metrics_t1.json"
-    assert run_state.exists() and metrics.exists()
-    for f in [run_state, metrics]:
-        with open(f, "r", encoding="utf-8") as fp:
-            json.load(fp)
+    run_data, _ = load_all([art.state / "run_t1.json", art.state / "metrics_t1.json"])
+    assert run_data["state"] == "completed"
+    # State writes go through tmp + os.replace; the first leftover is enough to report
+    leftover = next(glob.iglob("*.tmp", root_dir=art.state), None)
+    assert leftover is None, f"leftover tmp: {leftover}"
 
 
-def test_second_run_skips_stages():
-    stdout = run(["python", str(SRC), "--pipeline", str(PIPELINE), "--run-id", "t2"])
+@pytest.mark.xdist_group("first_run")
+def test_state_files_are_valid_json(first_run_artifacts):
+    # Every state file the run wrote, checked in one pass; failures are collected, not first-only
+    bad = []
+    with os.scandir(first_run_artifacts.state) as it:
+        for entry in it:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if not isinstance(load_json(entry.path), dict):
+                    bad.append((entry.name, "not an object"))
+            except ValueError as e:  # json and orjson decode errors both subclass it
+                bad.append((entry.name, str(e)))
+    assert not bad, bad
+
+
+@pytest.mark.xdist_group("first_run")
+def test_second_run_skips_stages(second_run):
+    rc, stdout, _ = second_run
+    assert rc == 0
     # Expect SKIP messages in stdout for both stages
     assert "[SKIP] stage_copy" in stdout
     assert "[SKIP] stage_upper" in stdout
 
 
-def test_checkpoint_resume():
-    # Simulate interruption mid-way by writing a progress file with offset
-    progress = STATE / "progress_stage_upper.json"
-    with open(progress, "w", encoding="utf-8") as fp:
-        json.dump({"lineOffset": 1}, fp)
+@pytest.mark.xdist_group("first_run")
+def test_metrics_aggregation(first_run_artifacts, second_run):
+    state = first_run_artifacts.state
+    first, second = load_all([state / "metrics_t1.json", state / "metrics_t2.json"])
+    assert (first["totalStages"], first["okStages"], first["skippedStages"]) == (2, 2, 0)
+    assert (second["totalStages"], second["okStages"], second["skippedStages"]) == (2, 0, 2)
+    assert [s["status"] for s in second["stages"]] == ["skipped", "skipped"]
+
+
+def test_checkpoint_resume(workspace, run_pipeline):
+    text = "".join(f"line {i}\n" for i in range(1, 6))
+    workspace.input.write_text(text, encoding="utf-8")
+    rc, _, _ = run_pipeline("t3a")
+    assert rc == 0
+    # Simulate an interruption after line 1: progress recorded at 1, output cut back to
+    # its first line plus a half-written second one
+    result = workspace.output / "result.txt"
+    with open(result, "rb") as fp:
+        first = fp.readline()
+    os.truncate(result, len(first))
+    with open(result, "ab") as fp:
+        fp.write(b"LI")
+    progress = workspace.state / "progress_stage_upper.json"
+    progress.write_text(json.dumps({"lineOffset": 1}), encoding="utf-8")
     # Remove completion marker to force execution
-    marker = OUTPUT / ".stage_upper.done"
-    if marker.exists():
-        marker.unlink()
-    # Run and verify it completes from offset (no assertion on content, but ensure completion marker exists)
-    stdout = run(["python", str(SRC), "--pipeline", str(PIPELINE), "--run-id", "t3"])
+    marker = workspace.output / ".stage_upper.done"
+    marker.unlink()
+    rc, stdout, _ = run_pipeline("t3b")
+    assert rc == 0
     assert "[DONE] stage_upper" in stdout
     assert marker.exists(), "Completion marker should be written on success"
+    # Resumed from line 1 without duplicating or keeping the partial line; progress is cleared
+    assert result.read_text(encoding="utf-8") == text.upper()
+    assert not progress.exists()
+
+
+@pytest.mark.parametrize("lines, output, offset", [
+    (120, b"", 100),
+    (4, b"LINE 1\nLI", 3),
+], ids=["empty", "partial-line"])
+def test_checkpoint_resume_short_output(workspace, run_pipeline, lines, output, offset):
+    # Progress claims more lines than reached the output (e.g. killed before a flush); the
+    # missing lines are redone rather than skipped, and a trailing fragment is dropped
+    text = "".join(f"line {i}\n" for i in range(1, lines + 1))
+    workspace.input.write_text(text, encoding="utf-8")
+    assert run_pipeline("t3c")[0] == 0
+    result = workspace.output / "result.txt"
+    result.write_bytes(output)
+    (workspace.state / "progress_stage_upper.json").write_text(json.dumps({"lineOffset": offset}), encoding="utf-8")
+    (workspace.output / ".stage_upper.done").unlink()
+    rc, stdout, _ = run_pipeline("t3d")
+    assert rc == 0, stdout
+    assert result.read_text(encoding="utf-8") == text.upper()
+
+
+def test_checkpoint_ignored_after_input_change(workspace, run_pipeline):
+    # Progress left by an interrupted run over the old input must not offset the new one
+    workspace.input.write_text("".join(f"old {i}\n" for i in range(5)), encoding="utf-8")
+    assert run_pipeline("t3e")[0] == 0
+    progress = workspace.state / "progress_stage_upper.json"
+    progress.write_text(json.dumps({"lineOffset": 3}), encoding="utf-8")
+    (workspace.output / ".stage_upper.done").unlink()
+    new = "".join(f"new {i}\n" for i in range(5))
+    workspace.input.write_text(new, encoding="utf-8")
+    rc, stdout, _ = run_pipeline("t3f")
+    assert rc == 0, stdout
+    assert (workspace.output / "result.txt").read_text(encoding="utf-8") == new.upper()
+    assert not progress.exists()
+
+
+def test_idempotency_key(pr, workspace):
+    processor = str(workspace.root / "proc.py")
+    # Reference digest from a plain read, independent of the runner's mmap hashing
+    digest = hashlib.sha256(workspace.input.read_bytes()).hexdigest()
+    expected = hashlib.sha256(f"{digest}|{pr.get_processor_version(processor)}".encode("utf-8")).hexdigest()
+    assert pr.compute_idempotency_key([str(workspace.input)], processor) == expected
+
+
+def test_idempotency_key_changes_with_content(pr, tmp_path):
+    processor = str(tmp_path / "proc.py")
+    a, b, empty = tmp_path / "a.txt", tmp_path / "b.txt", tmp_path / "empty.txt"
+    a.write_bytes(b"same prefix\n")
+    b.write_bytes(b"same prefix\nmarker")
+    empty.write_bytes(b"")
+    keys = {pr.compute_idempotency_key([str(p)], processor) for p in (a, b, empty)}
+    assert len(keys) == 3
+
+
+BAD_PIPELINE = json.dumps({
+    "name": "bad_pipeline",
+    "version": "1.0.0",
+    "stages": [{
+        "name": "bad_stage",
+        "processor": "bin/missing_processor.py",
+        "inputs": ["data/input/sample.txt"],
+        "outputDir": "data/work",
+        "idempotency": {"enabled": True},
+    }],
+}).encode("utf-8")
+
+
+def test_error_handling(workspace, run_pipeline, tmp_pipeline_factory):
+    rc, stdout, _ = run_pipeline("t_err", pipeline=tmp_pipeline_factory(BAD_PIPELINE))
+    assert rc == 1
+    assert "[FAIL] bad_stage" in stdout
+    assert load_json(workspace.state / "run_t_err.json")["state"] == "failed"
+    assert load_json(workspace.state / "stage_bad_stage.json")["lastStatus"] == "failed"
+
+
+def test_main_exit_code(pr, workspace, tmp_pipeline_factory, capsys, monkeypatch):
+    # CLI argument handling, covered in-process since the CLI subprocess is not measured
+    for k, v in workspace.env.items():
+        monkeypatch.setenv(k, v)
+    # argv=None reads sys.argv exactly as the CLI entrypoint does
+    monkeypatch.setattr(sys, "argv", ["pipeline_runner", "--pipeline", str(workspace.pipeline), "--run-id", "t_main"])
+    assert pr.main() == 0
+    assert pr.main(["--pipeline", str(tmp_pipeline_factory(BAD_PIPELINE)), "--run-id", "t_main_bad"]) == 1
+    assert "Run t_main_bad state: failed" in capsys.readouterr().out
+
+
+def test_main_dir_flags(pr, workspace, monkeypatch):
+    # --state-dir/--locks-dir apply to that run only; the caller's environment is restored
+    monkeypatch.delenv("PIPELINE_STATE_DIR", raising=False)
+    monkeypatch.setenv("PIPELINE_LOCKS_DIR", "elsewhere")
+    args = ["--pipeline", str(workspace.pipeline), "--run-id", "t_flags",
+            "--state-dir", str(workspace.state), "--locks-dir", str(workspace.locks)]
+    assert pr.main(args) == 0
+    assert (workspace.state / "run_t_flags.json").exists()
+    assert (workspace.locks / "stage_copy.lock").exists()
+    assert "PIPELINE_STATE_DIR" not in os.environ
+    assert os.environ["PIPELINE_LOCKS_DIR"] == "elsewhere"
+
+
+def test_multiple_lock_attempts(pr, tmp_path):
+    fcntl = pytest.importorskip("fcntl")
+    lock_path = tmp_path / "stage.lock"
+    with pr.FileLock(str(lock_path)):
+        fd = os.open(str(lock_path), os.O_RDWR)
+        try:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
+    # Released on exit, so the next holder gets it immediately
+    with pr.FileLock(str(lock_path)):
+        pass
+
+
+def test_stage_lock_failure(pr, workspace, run_pipeline):
+    # A concurrent holder of the stage lock makes the stage fail fast instead of racing it
+    lock = workspace.locks / "stage_copy.lock"
+    lock.parent.mkdir(exist_ok=True)
+    # The holder's stage state, which the losing run must not overwrite
+    stage_state = workspace.state / "stage_stage_copy.json"
+    stage_state.parent.mkdir(exist_ok=True)
+    holder = json.dumps({"lastStatus": "ok", "idempotencyKey": "held"}).encode("utf-8")
+    stage_state.write_bytes(holder)
+    with pr.FileLock(str(lock)):
+        rc, stdout, _ = run_pipeline("t_lock")
+    assert rc == 1
+    assert "[FAIL] stage_copy: Lock held" in stdout
+    assert stage_state.read_bytes() == holder
+    assert not (workspace.work / ".stage_copy.done").exists()
+    run_state, metrics = load_all([workspace.state / "run_t_lock.json", workspace.state / "metrics_t_lock.json"])
+    assert run_state["state"] == "failed"
+    assert metrics["failedStages"] == 1
+    assert metrics["stages"][0]["error"].startswith("Lock held")
+
+
+def test_apply_resource_limits(pr):
+    applied = pr.apply_resource_limits({"cpuCores": 2, "memoryMB": 256, "ioConcurrency": 1})
+    assert applied == {
+        "PIPELINE_CPU_CORES": "2",
+        "PIPELINE_MEMORY_MB": "256",
+        "PIPELINE_IO_CONCURRENCY": "1",
+    }
+    assert pr.apply_resource_limits({}) == {}
+
+
+# Records the resource env it was started with, then allocates `PIPELINE_TEST_ALLOC_MB` if set
+RESOURCE_PROCESSOR = """import os, json
+names = ("PIPELINE_CPU_CORES", "PIPELINE_MEMORY_MB", "PIPELINE_IO_CONCURRENCY")
+with open(os.path.join(os.environ["PIPELINE_OUTPUT_DIR"], "env.json"), "w") as f:
+    json.dump({n: os.environ.get(n) for n in names}, f)
+block = bytearray(int(os.environ.get("PIPELINE_TEST_ALLOC_MB", "0")) * 1024 * 1024)
+"""
+
+
+def resource_spec(tmp_path: Path, resources: dict) -> dict:
+    processor = tmp_path / "resources.py"
+    processor.write_text(RESOURCE_PROCESSOR, encoding="utf-8")
+    return {
+        "name": "resource_pipeline",
+        "version": "1.0.0",
+        "stages": [{
+            "name": "resource_stage",
+            "processor": str(processor),
+            "inputs": [],
+            "outputDir": str(tmp_path / "out"),
+            "resources": resources,
+        }],
+    }
+
+
+def test_resource_limit_env_propagation(tmp_path, run_pipeline, tmp_pipeline_factory):
+    spec = tmp_pipeline_factory(resource_spec(tmp_path, {"cpuCores": 2, "memoryMB": 1024, "ioConcurrency": 1}))
+    rc, stdout, _ = run_pipeline("t_res", pipeline=spec)
+    assert rc == 0, stdout
+    recorded = load_json(tmp_path / "out" / "env.json")
+    assert recorded == {"PIPELINE_CPU_CORES": "2", "PIPELINE_MEMORY_MB": "1024", "PIPELINE_IO_CONCURRENCY": "1"}
+    # Exported to the processor only; the runner's own environment is untouched
+    assert "PIPELINE_MEMORY_MB" not in os.environ
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="RLIMIT_AS is only enforced on Linux")
+def test_memory_limit_enforced(tmp_path, run_pipeline, tmp_pipeline_factory):
+    spec = tmp_pipeline_factory(resource_spec(tmp_path, {"memoryMB": 256}))
+    rc, stdout, _ = run_pipeline("t_mem", pipeline=spec, env={"PIPELINE_TEST_ALLOC_MB": "512"})
+    assert rc == 1
+    assert "[FAIL] resource_stage" in stdout and "MemoryError" in stdout
+    # Within the cap the same processor succeeds, so the failure comes from the limit
+    assert run_pipeline("t_mem_ok", pipeline=spec, env={"PIPELINE_TEST_ALLOC_MB": "16"})[0] == 0
+
+
+# Runs the `fail` statement (an exit or a self-kill) until it has been attempted `fail_times`
+# times; the runner's environment can override the count via PIPELINE_SIMULATE_TRANSIENT
+FLAKY_PROCESSOR = """import os, sys, signal
+fail_times = int(os.environ.get("PIPELINE_SIMULATE_TRANSIENT", "{fail_times}"))
+counter = os.path.join(os.environ["PIPELINE_OUTPUT_DIR"], "attempts.txt")
+n = int(open(counter).read()) if os.path.exists(counter) else 0
+open(counter, "w").write(str(n + 1))
+if n < fail_times:
+    {fail}
+"""
+
+
+def flaky_spec(tmp_path: Path, fail_times: int, retry: dict, fail: str = "sys.exit(75)") -> dict:
+    processor = tmp_path / "flaky.py"
+    processor.write_text(FLAKY_PROCESSOR.format(fail_times=fail_times, fail=fail), encoding="utf-8")
+    return {
+        "name": "flaky_pipeline",
+        "version": "1.0.0",
+        "stages": [{
+            "name": "flaky_stage",
+            "processor": str(processor),
+            "inputs": [],
+            "outputDir": str(tmp_path / "out"),
+            "retry": retry,
+        }],
+    }
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("via_env", [False, True], ids=["simulateTransient", "PIPELINE_SIMULATE_TRANSIENT"])
+def test_retry_backoff_timing(pr, monkeypatch, workspace, run_pipeline, tmp_pipeline_factory, via_env):
+    # Delays come from the spec here, even when CI exports the backoff overrides
+    monkeypatch.delenv("PIPELINE_RETRY_BASE_DELAY", raising=False)
+    monkeypatch.delenv("PIPELINE_RETRY_JITTER", raising=False)
+    sleeps = []
+    monkeypatch.setattr(pr, "sleep", sleeps.append)
+    spec = tmp_pipeline_factory(flaky_spec(workspace.root, 0 if via_env else 2,
+                                           {"maxAttempts": 4, "baseDelay": 0.5, "jitter": 0}))
+    env = {"PIPELINE_SIMULATE_TRANSIENT": "2"} if via_env else None
+    rc, stdout, _ = run_pipeline("t_retry", pipeline=spec, env=env)
+    assert rc == 0, stdout
+    assert stdout.count("[RETRY] flaky_stage") == 2
+    # Exponential policy is visible in the requested delays; nothing actually sleeps
+    assert sleeps == [0.5, 1.0]
+    assert load_json(workspace.state / "stage_flaky_stage.json")["lastAttempts"] == 3
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("fail, should_retry", [
+    *[pytest.param(f"sys.exit({code})", code in (75, 130, 137, 143), id=str(code))
+      for code in (75, 130, 137, 143, 1, 2, 139)],
+    # A real signal death comes back as returncode -15 and must be retried as 143
+    pytest.param("os.kill(os.getpid(), signal.SIGTERM)", True, id="SIGTERM",
+                 marks=pytest.mark.skipif(sys.platform == "win32", reason="no POSIX signal deaths")),
+])
+def test_retry_transient_failure(workspace, run_pipeline, tmp_pipeline_factory, fail, should_retry):
+    # Only the whitelisted transient codes retry; crashes like SIGSEGV (139) fail fast
+    retry = {"maxAttempts": 3, "baseDelay": 0.5, "retryableExitCodes": [75, 130, 137, 143]}
+    spec = tmp_pipeline_factory(flaky_spec(workspace.root, 1, retry, fail=fail))
+    # The env override shrinks the spec's 0.5s backoff so the real sleep stays negligible
+    fast = {"PIPELINE_RETRY_BASE_DELAY": "0.001", "PIPELINE_RETRY_JITTER": "0"}
+    rc, _, _ = run_pipeline("t_transient", pipeline=spec, env=fast)
+    attempts = load_json(workspace.state / "stage_flaky_stage.json")["lastAttempts"]
+    if should_retry:
+        assert (rc, attempts) == (0, 2)
+    else:
+        assert (rc, attempts) == (1, 1)
+
+
+def test_full_execution_path(tmp_path, run_pipeline, tmp_pipeline_factory):
+    source = tmp_path / "input" / "lines.txt"
+    source.parent.mkdir()
+    source.write_text("".join(f"line {i}\n" for i in range(1, 121)), encoding="utf-8")
+    spec = tmp_pipeline_factory({
+        "name": "full_pipeline",
+        "version": "1.0.0",
+        "stages": [
+            {"name": "full_copy", "processor": "bin/stage_copy.py",
+             "inputs": [str(source)], "outputDir": str(tmp_path / "work")},
+            {"name": "full_upper", "processor": "bin/stage_upper.py",
+             "inputs": [str(tmp_path / "work" / "lines.txt")], "outputDir": str(tmp_path / "output")},
+        ],
+    })
+    rc, stdout, _ = run_pipeline("t_full", pipeline=spec)
+    assert rc == 0, stdout
+    data = (tmp_path / "output" / "result.txt").read_bytes()
+    assert data.count(b"\n") >= 100
+    assert data.startswith(b"LINE 1")
+
+
+def _py_files(path: str):
+    # scandir entries carry their type, so pruning and filtering need no extra stat calls
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if not (entry.name.startswith(".") or entry.name in SKIP_DIRS or entry.name.endswith(".egg-info")):
+                    yield from _py_files(entry.path)
+            elif entry.name.endswith(".py") and entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+def test_no_network_imports():
+    root = Path(__file__).resolve().parents[1]
+    offenders = []
+    for path in _py_files(str(root)):
+        with open(path, "rb") as fp:
+            m = NETWORK_IMPORT.search(fp.read())
+        if m:
+            offenders.append((path, m.group(1).decode()))
+    assert not offenders, f"Network imports found: {offenders}"